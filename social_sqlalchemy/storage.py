@@ -1,12 +1,12 @@
 """SQLAlchemy models for Social Auth"""
 
-import base64
 import json
+from weakref import WeakValueDictionary
 
 try:
-    import transaction
+    import orjson
 except ImportError:
-    transaction = None
+    orjson = None
 
 from social_core.storage import (
     AssociationMixin,
@@ -16,12 +16,43 @@ from social_core.storage import (
     PartialMixin,
     UserMixin,
 )
-from sqlalchemy import Integer, String, delete, func, select
+from sqlalchemy import (
+    Integer,
+    String,
+    bindparam,
+    delete,
+    func,
+    inspect,
+    literal,
+    select,
+)
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.orm import Mapped, declared_attr, mapped_column
+from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.schema import UniqueConstraint
-from sqlalchemy.types import PickleType, Text
+from sqlalchemy.types import Text, TypeDecorator
+
+
+def _json_dumps(value):
+    """Serialize with orjson when available, json for what it rejects"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            # Integers over 64 bits among others
+            pass
+    return json.dumps(value)
+
+
+def _json_loads(value):
+    """Parse with orjson when available, json for what it rejects"""
+    if orjson is not None:
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            # NaN and Infinity written by json
+            pass
+    return json.loads(value)
 
 
 class JSONPickler:
@@ -33,25 +64,35 @@ class JSONPickler:
     @classmethod
     def dumps(cls, value, *args, **kwargs):
         """Dumps the python value into a JSON string"""
-        return json.dumps(value)
+        return _json_dumps(value)
 
     @classmethod
     def loads(cls, value):
         """Parses the JSON string and returns the corresponding python value"""
-        return json.loads(value)
+        return _json_loads(value)
 
 
 # JSON type field
-class JSONType(PickleType):
+class JSONType(TypeDecorator):
+    """Stores JSON serializable values in a text column"""
+
     impl = Text
+    cache_ok = True
 
-    def __init__(self, *args, **kwargs):
-        kwargs["pickler"] = JSONPickler
-        super().__init__(*args, **kwargs)
+    def process_bind_param(self, value, dialect):
+        return None if value is None else _json_dumps(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else _json_loads(value)
 
 
 class SQLAlchemyMixin:
-    COMMIT_SESSION = True
+    # Instances are only flushed by default, committing the session is left
+    # to the framework integration (usually a scoped session committed on
+    # request teardown, see finalize()). Set AUTO_COMMIT (or the legacy
+    # COMMIT_SESSION) to commit on every save instead.
+    AUTO_COMMIT = False
+    COMMIT_SESSION = False
 
     @classmethod
     def _session(cls):
@@ -61,6 +102,61 @@ class SQLAlchemyMixin:
     def _query(cls):
         return select(cls)
 
+    @classmethod
+    def _exists_query(cls, model=None):
+        """
+        Return a select() over model (or this model) that doesn't load any
+        columns, to be wrapped in EXISTS
+        """
+        return select(literal(1)).select_from(model or cls)
+
+    @classmethod
+    def _filter_query(cls, *names):
+        """
+        Return a select() for this model filtering by equality on the given
+        column names, each one bound to a bindparam() of the same name. The
+        statement is built once per model and reused in later calls. Values
+        must not be None, "column = NULL" never matches.
+        """
+        statements = cls.__dict__.get("_statements")
+        if statements is None:
+            statements = {}
+            cls._statements = statements
+        stmt = statements.get(names)
+        if stmt is None:
+            stmt = cls._query().where(
+                *(getattr(cls, name) == bindparam(name) for name in names)
+            )
+            statements[names] = stmt
+        return stmt
+
+    @classmethod
+    def _get_by(cls, name, value):
+        """
+        Return the instance with the given value on the name column, reusing
+        the one already loaded by this session (if it's still current) to
+        skip the SELECT when looked up more than once per request.
+        """
+        session = cls._session()
+        loaded = session.info.get("social_auth_loaded")
+        if loaded is None:
+            loaded = session.info["social_auth_loaded"] = WeakValueDictionary()
+        key = (cls, name, value)
+        instance = loaded.get(key)
+        if instance is not None:
+            state = inspect(instance)
+            if (
+                not state.expired
+                and instance in session
+                and instance not in session.deleted
+                and getattr(instance, name) == value
+            ):
+                return instance
+        instance = session.scalar(cls._filter_query(name), {name: value})
+        if instance is not None:
+            loaded[key] = instance
+        return instance
+
     @classmethod
     def _new_instance(cls, model, *args, **kwargs):
         return cls._save_instance(model(*args, **kwargs))
@@ -68,23 +164,114 @@ class SQLAlchemyMixin:
     @classmethod
     def _save_instance(cls, instance):
         cls._session().add(instance)
-        if cls.COMMIT_SESSION:
+        if cls.AUTO_COMMIT or cls.COMMIT_SESSION:
             cls._session().commit()
-            cls._session().flush()
         else:
             cls._flush()
         return instance
 
+    @classmethod
+    def _upsert(cls, values, conflict_columns):
+        """
+        Insert a row with the given values or update the one matching the
+        values of conflict_columns (which must be covered by a unique
+        constraint) in a single statement. Dialects without upsert support
+        fall back to a select followed by a save. Instances already loaded
+        in the session are refreshed with the stored values.
+        """
+        session = cls._session()
+        dialect = session.get_bind(cls).dialect
+        updates = {
+            name: value
+            for name, value in values.items()
+            if name not in conflict_columns
+        }
+        if dialect.name == "postgresql" or (
+            # ON CONFLICT was added in SQLite 3.24
+            dialect.name == "sqlite" and dialect.server_version_info >= (3, 24)
+        ):
+            if dialect.name == "postgresql":
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            stmt = (
+                insert(cls)
+                .values(**values)
+                .on_conflict_do_update(
+                    index_elements=list(conflict_columns), set_=updates
+                )
+            )
+            if dialect.insert_returning:
+                # Consume the returned row so a loaded instance gets refreshed
+                session.scalars(
+                    stmt.returning(cls),
+                    execution_options={"populate_existing": True},
+                ).one()
+            else:
+                session.execute(stmt)
+                cls._expire_loaded(values, conflict_columns)
+        elif dialect.name in ("mysql", "mariadb"):
+            from sqlalchemy.dialects.mysql import insert
+
+            # LAST_INSERT_ID(id) reports the id of the updated row too, use it
+            # to expire the loaded instance as there's no RETURNING support
+            result = session.execute(
+                insert(cls)
+                .values(**values)
+                .on_duplicate_key_update(id=func.last_insert_id(cls.id), **updates)
+            )
+            instance = session.identity_map.get(
+                session.identity_key(cls, result.inserted_primary_key)
+            )
+            if instance is not None:
+                session.expire(instance)
+        else:
+            instance = session.scalar(
+                cls._filter_query(*conflict_columns),
+                {name: values[name] for name in conflict_columns},
+            )
+            if instance is None:
+                instance = cls(**values)
+            else:
+                for name, value in updates.items():
+                    setattr(instance, name, value)
+            cls._save_instance(instance)
+            return
+
+        if cls.AUTO_COMMIT or cls.COMMIT_SESSION:
+            session.commit()
+
+    @classmethod
+    def _expire_loaded(cls, values, conflict_columns):
+        """
+        Expire the instance of this model loaded in the session (if any)
+        matching the values of conflict_columns
+        """
+        session = cls._session()
+        for key, instance in list(session.identity_map.items()):
+            if key[0] is cls:
+                loaded = inspect(instance).dict
+                if all(loaded.get(name) == values[name] for name in conflict_columns):
+                    session.expire(instance)
+                    return
+
     @classmethod
     def _flush(cls):
         try:
             cls._session().flush()
         except AssertionError:
-            if transaction:
+            try:
+                import transaction
+            except ImportError:
+                cls._session().commit()
+            else:
                 with transaction.manager as manager:
                     manager.commit()
-            else:
-                cls._session().commit()
+
+    @classmethod
+    def finalize(cls):
+        """Commit the pending unit of work, call it on request teardown"""
+        cls._session().commit()
 
     def save(self):
         self._save_instance(self)
@@ -94,8 +281,13 @@ class SQLAlchemyUserMixin(SQLAlchemyMixin, UserMixin):
     """Social Auth association model"""
 
     __tablename__ = "social_auth_usersocialauth"
+    # The unique constraint is backed by a (provider, uid) index on every
+    # supported backend, which is what get_social_auth() looks up by, keep
+    # the column order in sync with that query.
     __table_args__ = (UniqueConstraint("provider", "uid"),)
     id: Mapped[int] = mapped_column(primary_key=True)
+    # Backends are pluggable so provider names aren't a closed set, keep a
+    # plain string instead of an Enum that would need a migration per backend
     provider: Mapped[str] = mapped_column(String(32))
     uid: Mapped[str] = mapped_column(String(255))
     user_id = None
@@ -103,7 +295,8 @@ class SQLAlchemyUserMixin(SQLAlchemyMixin, UserMixin):
 
     @declared_attr
     def extra_data(cls) -> Mapped[dict[str, str] | None]:
-        return mapped_column(MutableDict.as_mutable(JSONType))
+        # In-place changes aren't tracked, assign a new dict to update it
+        return mapped_column(JSONType)
 
     @classmethod
     def changed(cls, user):
@@ -111,35 +304,41 @@ class SQLAlchemyUserMixin(SQLAlchemyMixin, UserMixin):
 
     def set_extra_data(self, extra_data=None):
         if super().set_extra_data(extra_data):
+            # The base implementation may update the dict in place, which
+            # isn't tracked, flag the attribute as changed explicitly
+            flag_modified(self, "extra_data")
             self._save_instance(self)
 
     @classmethod
     def allowed_to_disconnect(cls, user, backend_name, association_id=None):
+        has_usable_password = getattr(user, "has_usable_password", None)
+        if has_usable_password is None or has_usable_password():
+            return True
+
         if association_id is not None:
-            qs = cls._query().where(cls.id != association_id)
+            qs = cls._exists_query().where(cls.id != association_id)
         else:
-            qs = cls._query().where(cls.provider != backend_name)
+            qs = cls._exists_query().where(cls.provider != backend_name)
         qs = qs.where(cls.user == user)
-
-        if hasattr(user, "has_usable_password"):  # TODO
-            valid_password = user.has_usable_password()
-        else:
-            valid_password = True
-
-        qs_count = cls._session().scalar(
-            select(func.count()).select_from(qs.subquery())
-        )
-
-        return valid_password or qs_count > 0
+        return cls._session().scalar(select(qs.exists()))
 
     @classmethod
     def disconnect(cls, entry):
         cls._session().delete(entry)
         cls._flush()
 
+    @classmethod
+    def _user_model(cls):
+        """Return user_model(), resolved once per model"""
+        model = cls.__dict__.get("_resolved_user_model")
+        if model is None:
+            model = cls.user_model()
+            cls._resolved_user_model = model
+        return model
+
     @classmethod
     def user_query(cls):
-        return select(cls.user_model())
+        return select(cls._user_model())
 
     @classmethod
     def user_exists(cls, *args, **kwargs):
@@ -147,13 +346,8 @@ class SQLAlchemyUserMixin(SQLAlchemyMixin, UserMixin):
         Return True/False if a User instance exists with the given arguments.
         Arguments are directly passed to filter() manager method.
         """
-        stmt = cls.user_query().filter_by(*args, **kwargs)
-
-        user_count = cls._session().scalar(
-            select(func.count()).select_from(stmt.subquery())
-        )
-
-        return user_count > 0
+        stmt = cls._exists_query(cls._user_model()).filter_by(*args, **kwargs)
+        return cls._session().scalar(select(stmt.exists()))
 
     @classmethod
     def get_username(cls, user):
@@ -161,11 +355,13 @@ class SQLAlchemyUserMixin(SQLAlchemyMixin, UserMixin):
 
     @classmethod
     def create_user(cls, *args, **kwargs):
-        return cls._new_instance(cls.user_model(), *args, **kwargs)
+        return cls._new_instance(cls._user_model(), *args, **kwargs)
 
     @classmethod
     def get_user(cls, pk):
-        return cls._session().get(cls.user_model(), pk)
+        # Session.get() returns the instance from the identity map without
+        # emitting SQL when already loaded (populate_existing stays off)
+        return cls._session().get(cls._user_model(), pk)
 
     @classmethod
     def get_users_by_email(cls, email):
@@ -175,12 +371,10 @@ class SQLAlchemyUserMixin(SQLAlchemyMixin, UserMixin):
     def get_social_auth(cls, provider, uid):
         if not isinstance(uid, str):
             uid = str(uid)
-        try:
-            return cls._session().scalar(
-                cls._query().filter_by(provider=provider, uid=uid)
-            )
-        except IndexError:
-            return None
+        return cls._session().scalar(
+            cls._filter_query("provider", "uid"),
+            {"provider": provider, "uid": uid},
+        )
 
     @classmethod
     def get_social_auth_for_user(cls, user, provider=None, id=None):
@@ -209,15 +403,16 @@ class SQLAlchemyNonceMixin(SQLAlchemyMixin, NonceMixin):
 
     @classmethod
     def use(cls, server_url, timestamp, salt):
+        """Create the nonce and return True, or False if already used"""
         kwargs = {  # fix: skip
             "server_url": server_url,
             "timestamp": timestamp,
             "salt": salt,
         }
-        try:
-            return cls._session().scalar(cls._query().filter_by(**kwargs))
-        except IndexError:
-            return cls._new_instance(cls, **kwargs)
+        if cls._session().scalar(cls._filter_query(*kwargs), kwargs) is not None:
+            return False
+        cls._new_instance(cls, **kwargs)
+        return True
 
 
 class SQLAlchemyAssociationMixin(SQLAlchemyMixin, AssociationMixin):
@@ -231,35 +426,47 @@ class SQLAlchemyAssociationMixin(SQLAlchemyMixin, AssociationMixin):
     lifetime: Mapped[int] = mapped_column()
     assoc_type: Mapped[str] = mapped_column(String(64))
 
+    # Max number of ids deleted per statement by remove()
+    REMOVE_CHUNK_SIZE = 100
+
     @classmethod
     def store(cls, server_url, association):
-        # Don't use get_or_create because issued cannot be null
-        try:
-            assoc = cls._session().scalar(  # fix: skip
-                cls._query().filter_by(
-                    server_url=server_url,  # fix: skip
-                    handle=association.handle,  # fix: skip
-                )
-            )
-        except IndexError:
-            assoc = cls(server_url=server_url, handle=association.handle)
-        assoc.secret = base64.encodebytes(association.secret).decode()
-        assoc.issued = association.issued
-        assoc.lifetime = association.lifetime
-        assoc.assoc_type = association.assoc_type
-        cls._save_instance(assoc)
+        import base64
+
+        cls._upsert(
+            {
+                "server_url": server_url,
+                "handle": association.handle,
+                "secret": base64.b64encode(association.secret).decode("ascii"),
+                "issued": association.issued,
+                "lifetime": association.lifetime,
+                "assoc_type": association.assoc_type,
+            },
+            ("server_url", "handle"),
+        )
 
     @classmethod
-    def get(cls, *args, **kwargs):
-        return cls._session().scalar(cls._query().filter_by(*args, **kwargs))
+    def get(cls, **kwargs):
+        if None in kwargs.values():
+            # filter_by() compiles None to IS NULL, a bindparam() can't
+            return cls._session().scalar(cls._query().filter_by(**kwargs))
+        return cls._session().scalar(cls._filter_query(*kwargs), kwargs)
 
     @classmethod
     def remove(cls, ids_to_delete):
-        cls._session().execute(
-            delete(
-                cls._query().where(cls.id.in_(ids_to_delete))  # fix: skip
-            ).execution_options(synchronize_session="fetch")
+        # Deleted rows aren't synchronized with the session, associations
+        # aren't kept loaded between requests
+        session = cls._session()
+        stmt = (
+            delete(cls)
+            .where(cls.id.in_(bindparam("ids", expanding=True)))
+            .execution_options(synchronize_session=False)
         )
+        ids_to_delete = list(ids_to_delete)
+        for start in range(0, len(ids_to_delete), cls.REMOVE_CHUNK_SIZE):
+            session.execute(
+                stmt, {"ids": ids_to_delete[start : start + cls.REMOVE_CHUNK_SIZE]}
+            )
 
 
 class SQLAlchemyCodeMixin(SQLAlchemyMixin, CodeMixin):
@@ -271,28 +478,30 @@ class SQLAlchemyCodeMixin(SQLAlchemyMixin, CodeMixin):
 
     @classmethod
     def get_code(cls, code):
-        return cls._session().scalar(cls._query().where(cls.code == code))
+        return cls._get_by("code", code)
 
 
 class SQLAlchemyPartialMixin(SQLAlchemyMixin, PartialMixin):
     __tablename__ = "social_auth_partial"
     id: Mapped[int] = mapped_column(primary_key=True)
     token: Mapped[str] = mapped_column(String(32), index=True)
-    data: Mapped[dict[str, str]] = mapped_column(  # fix: skip
-        MutableDict.as_mutable(JSONType)
-    )
+    data: Mapped[dict[str, str]] = mapped_column(JSONType)
     next_step: Mapped[int] = mapped_column()
     backend: Mapped[str] = mapped_column(String(32))
 
     @classmethod
     def load(cls, token):
-        return cls._session().scalar(cls._query().where(cls.token == token))
+        return cls._get_by("token", token)
 
     @classmethod
     def destroy(cls, token):
-        partial = cls.load(token)
-        if partial:
-            cls._session().delete(partial)
+        # "evaluate" marks an already loaded partial as deleted without
+        # another round-trip, so load() won't return it afterwards
+        cls._session().execute(
+            delete(cls)
+            .where(cls.token == token)
+            .execution_options(synchronize_session="evaluate")
+        )
 
 
 class BaseSQLAlchemyStorage(BaseStorage):
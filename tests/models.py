@@ -0,0 +1,77 @@
+"""Concrete models mapped over the storage mixins, backed by SQLite"""
+
+from sqlalchemy import ForeignKey, String, create_engine
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    Mapped,
+    mapped_column,
+    relationship,
+    scoped_session,
+    sessionmaker,
+)
+
+from social_sqlalchemy.storage import (
+    BaseSQLAlchemyStorage,
+    SQLAlchemyAssociationMixin,
+    SQLAlchemyCodeMixin,
+    SQLAlchemyNonceMixin,
+    SQLAlchemyPartialMixin,
+    SQLAlchemyUserMixin,
+)
+
+engine = create_engine("sqlite://")
+session = scoped_session(sessionmaker(bind=engine))
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class User(Base):
+    __tablename__ = "users"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    username: Mapped[str] = mapped_column(String(200))
+    email: Mapped[str | None] = mapped_column(String(200))
+    password: Mapped[str | None] = mapped_column(String(200))
+
+    def has_usable_password(self):
+        return bool(self.password)
+
+
+class SessionMixin:
+    @classmethod
+    def _session(cls):
+        return session
+
+
+class UserSocialAuth(SessionMixin, SQLAlchemyUserMixin, Base):
+    user_id: Mapped[int] = mapped_column(ForeignKey(User.id))
+    user: Mapped[User] = relationship(User)
+
+    @classmethod
+    def user_model(cls):
+        return User
+
+
+class Nonce(SessionMixin, SQLAlchemyNonceMixin, Base):
+    pass
+
+
+class Association(SessionMixin, SQLAlchemyAssociationMixin, Base):
+    pass
+
+
+class Code(SessionMixin, SQLAlchemyCodeMixin, Base):
+    pass
+
+
+class Partial(SessionMixin, SQLAlchemyPartialMixin, Base):
+    pass
+
+
+class Storage(BaseSQLAlchemyStorage):
+    user = UserSocialAuth
+    nonce = Nonce
+    association = Association
+    code = Code
+    partial = Partial
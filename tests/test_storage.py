@@ -0,0 +1,286 @@
+import math
+import unittest
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest import mock
+
+from sqlalchemy import event, select, text
+
+from social_sqlalchemy import storage
+
+from .models import (
+    Association,
+    Base,
+    Code,
+    Nonce,
+    Partial,
+    UserSocialAuth,
+    engine,
+    session,
+)
+
+
+class BaseStorageTest(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        session.remove()
+        Base.metadata.drop_all(engine)
+
+    def reload(self, instance):
+        """Return a fresh copy of instance read from the database"""
+        session.commit()
+        pk = instance.id
+        session.expunge_all()
+        return session.get(type(instance), pk)
+
+    @contextmanager
+    def capture_queries(self):
+        """Collect the SQL statements executed within the block"""
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield queries
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+class UserSocialAuthTest(BaseStorageTest):
+    def setUp(self):
+        super().setUp()
+        self.user = UserSocialAuth.create_user(username="foobar")
+        self.social = UserSocialAuth.create_social_auth(self.user, 1, "github")
+
+    def test_set_extra_data(self):
+        self.social.set_extra_data({"access_token": "old"})
+        social = self.reload(self.social)
+        self.assertEqual(social.extra_data, {"access_token": "old"})
+
+    def test_update_extra_data(self):
+        self.social.set_extra_data({"access_token": "old", "expires": 10})
+        session.commit()
+        self.social.set_extra_data({"access_token": "new"})
+        social = self.reload(self.social)
+        self.assertEqual(social.extra_data, {"access_token": "new", "expires": 10})
+
+    def test_allowed_to_disconnect_with_password(self):
+        self.user.password = "secret"
+        with self.capture_queries() as queries:
+            self.assertTrue(UserSocialAuth.allowed_to_disconnect(self.user, "github"))
+        self.assertEqual(queries, [])
+
+    def test_allowed_to_disconnect_last_provider(self):
+        self.assertFalse(UserSocialAuth.allowed_to_disconnect(self.user, "github"))
+        UserSocialAuth.create_social_auth(self.user, 1, "gitlab")
+        self.assertTrue(UserSocialAuth.allowed_to_disconnect(self.user, "github"))
+
+    def test_allowed_to_disconnect_last_association(self):
+        self.assertFalse(
+            UserSocialAuth.allowed_to_disconnect(
+                self.user, "github", association_id=self.social.id
+            )
+        )
+        UserSocialAuth.create_social_auth(self.user, 2, "github")
+        self.assertTrue(
+            UserSocialAuth.allowed_to_disconnect(
+                self.user, "github", association_id=self.social.id
+            )
+        )
+
+
+class JSONTypeTest(BaseStorageTest):
+    def setUp(self):
+        super().setUp()
+        user = UserSocialAuth.create_user(username="foobar")
+        self.social = UserSocialAuth.create_social_auth(user, 1, "github")
+
+    def serializers(self):
+        """Run the block once per available serializer (orjson and json)"""
+        modules = [None]
+        if storage.orjson is not None:
+            modules.append(storage.orjson)
+        for module in modules:
+            with (
+                self.subTest(orjson=module),
+                mock.patch.object(storage, "orjson", module),
+            ):
+                yield
+
+    def test_round_trip(self):
+        for _ in self.serializers():
+            self.social.extra_data = {"token": "abc", "expires": 10, 1: "one"}
+            self.social = self.reload(self.social)
+            self.assertEqual(
+                self.social.extra_data, {"token": "abc", "expires": 10, "1": "one"}
+            )
+
+    def test_big_integer(self):
+        for _ in self.serializers():
+            self.social.extra_data = {"id": 2**70}
+            self.social = self.reload(self.social)
+            self.assertEqual(self.social.extra_data["id"], 2**70)
+
+    def test_load_non_finite(self):
+        session.execute(
+            text("UPDATE social_auth_usersocialauth SET extra_data = :value"),
+            {"value": '{"a": NaN, "b": Infinity}'},
+        )
+        for _ in self.serializers():
+            self.social = self.reload(self.social)
+            self.assertTrue(math.isnan(self.social.extra_data["a"]))
+            self.assertEqual(self.social.extra_data["b"], math.inf)
+
+
+class NonceTest(BaseStorageTest):
+    def test_use(self):
+        self.assertTrue(Nonce.use("https://example.com", 1, "salt"))
+        self.assertEqual(session.query(Nonce).count(), 1)
+
+    def test_use_twice(self):
+        self.assertTrue(Nonce.use("https://example.com", 1, "salt"))
+        self.assertFalse(Nonce.use("https://example.com", 1, "salt"))
+        self.assertTrue(Nonce.use("https://example.com", 1, "pepper"))
+
+
+class AssociationTest(BaseStorageTest):
+    def association(self, secret, issued):
+        return SimpleNamespace(
+            handle="handle",
+            secret=secret,
+            issued=issued,
+            lifetime=3600,
+            assoc_type="HMAC-SHA1",
+        )
+
+    def test_store(self):
+        Association.store("https://example.com", self.association(b"secret", 1))
+        assoc = Association.get(server_url="https://example.com", handle="handle")
+        self.assertEqual(assoc.secret, "c2VjcmV0")
+        self.assertEqual(assoc.issued, 1)
+
+    def test_store_updates_loaded_instance(self):
+        Association.store("https://example.com", self.association(b"old", 1))
+        assoc = Association.get(server_url="https://example.com", handle="handle")
+        Association.store("https://example.com", self.association(b"new", 2))
+        self.assertIs(
+            Association.get(server_url="https://example.com", handle="handle"),
+            assoc,
+        )
+        self.assertEqual(assoc.secret, "bmV3")
+        self.assertEqual(assoc.issued, 2)
+        self.assertEqual(session.query(Association).count(), 1)
+
+    def assert_store_refreshes(self, upsert):
+        Association.store("https://example.com", self.association(b"old", 1))
+        assoc = Association.get(server_url="https://example.com", handle="handle")
+        with self.capture_queries() as queries:
+            Association.store("https://example.com", self.association(b"new", 2))
+        self.assertEqual(upsert, any("ON CONFLICT" in query for query in queries))
+        self.assertFalse(any("RETURNING" in query for query in queries))
+        self.assertEqual(assoc.secret, "bmV3")
+        self.assertEqual(assoc.issued, 2)
+        self.assertEqual(session.query(Association).count(), 1)
+
+    def test_store_without_returning(self):
+        with mock.patch.object(engine.dialect, "insert_returning", False):
+            self.assert_store_refreshes(upsert=True)
+
+    def test_store_without_on_conflict(self):
+        with mock.patch.object(engine.dialect, "insert_returning", False):
+            with mock.patch.object(engine.dialect, "server_version_info", (3, 23)):
+                self.assert_store_refreshes(upsert=False)
+
+    def test_remove(self):
+        for handle in range(150):
+            Association.store(
+                "https://example.com",
+                SimpleNamespace(
+                    handle=str(handle),
+                    secret=b"secret",
+                    issued=1,
+                    lifetime=3600,
+                    assoc_type="HMAC-SHA1",
+                ),
+            )
+        ids = session.scalars(select(Association.id)).all()
+        with self.capture_queries() as queries:
+            Association.remove(pk for pk in ids[:120])
+        deletes = [query for query in queries if query.startswith("DELETE")]
+        self.assertEqual(len(deletes), 2)
+        self.assertEqual(
+            session.scalars(select(Association.id)).all(),
+            ids[120:],
+        )
+
+    def test_get_by_server_url(self):
+        Association.store("https://example.com", self.association(b"secret", 1))
+        assoc = Association.get(server_url="https://example.com")
+        self.assertEqual(assoc.handle, "handle")
+        self.assertIsNone(Association.get(server_url="https://example.org"))
+
+    def test_get_none_value(self):
+        Association.store("https://example.com", self.association(b"secret", 1))
+        with self.capture_queries() as queries:
+            self.assertIsNone(
+                Association.get(server_url="https://example.com", handle=None)
+            )
+        self.assertIn("IS NULL", queries[0])
+
+
+class CodeTest(BaseStorageTest):
+    def test_get_code(self):
+        code = Code.make_code("foo@example.com")
+        self.assertIs(Code.get_code(code.code), code)
+        self.assertIsNone(Code.get_code("missing"))
+
+    def test_get_code_twice(self):
+        code = Code.make_code("foo@example.com")
+        with self.capture_queries() as queries:
+            Code.get_code(code.code)
+        self.assertEqual(len(queries), 1)
+        with self.capture_queries() as queries:
+            self.assertIs(Code.get_code(code.code), code)
+        self.assertEqual(queries, [])
+
+
+class PartialTest(BaseStorageTest):
+    def setUp(self):
+        super().setUp()
+        self.partial = Partial._new_instance(
+            Partial, token="token", data={"kwargs": {}}, next_step=1, backend="github"
+        )
+
+    def test_load_twice(self):
+        with self.capture_queries() as queries:
+            self.assertIs(Partial.load("token"), self.partial)
+        self.assertEqual(len(queries), 1)
+        with self.capture_queries() as queries:
+            self.assertIs(Partial.load("token"), self.partial)
+        self.assertEqual(queries, [])
+
+    def test_load_after_destroy(self):
+        Partial.load("token")
+        Partial.destroy("token")
+        with self.capture_queries() as queries:
+            self.assertIsNone(Partial.load("token"))
+        self.assertEqual(len(queries), 1)
+
+    def test_load_after_commit(self):
+        Partial.load("token")
+        session.commit()
+        with self.capture_queries() as queries:
+            self.assertIs(Partial.load("token"), self.partial)
+        self.assertTrue(queries)
+
+    def test_load_after_token_change(self):
+        Partial.load("token")
+        self.partial.token = "other"
+        with self.capture_queries() as queries:
+            self.assertIsNone(Partial.load("token"))
+        self.assertTrue(queries)
+        self.assertIs(Partial.load("other"), self.partial)